@@ -2,6 +2,7 @@
 import contextlib
 import difflib
 import fcntl
+import functools
 import glob
 import hashlib
 import os
@@ -21,15 +22,21 @@ import attr
 import icdiff
 from logzero import logger
 from termcolor import colored
-import toml
 
 from .exceptions import (
     IrodsIcommandsUnavailableException,
     IrodsIcommandsUnavailableWarning,
 )
 
-#: Paths to search the global configuration in.
-GLOBAL_CONFIG_PATHS = ("~/.cubitkrc.toml",)
+
+@functools.lru_cache(maxsize=None)
+def _resolve_config_path(config_path) -> pathlib.Path:
+    """Expand environment variables and user home in ``config_path``."""
+    return pathlib.Path(os.path.expandvars(config_path)).expanduser()
+
+
+#: Paths to search the global configuration in, resolved at import time.
+GLOBAL_CONFIG_PATHS = tuple(map(_resolve_config_path, ("~/.cubitkrc.toml",)))
 
 
 def mask_password(value: str) -> str:
@@ -364,15 +371,24 @@ class UnionFind:
 
 
 def load_toml_config(config):
-    # Load configuration from TOML cubitkrc file, if any.
+    # Load configuration from TOML cubitkrc file, if any.  The TOML parser is imported lazily
+    # as the import dominates startup time for most commands; prefer ``tomllib`` (Python 3.11+).
+    try:
+        import tomllib as toml_parser
+    except ImportError:
+        import toml as toml_parser  # type: ignore
+
     if config.config:
-        config_paths = (config.config,)
+        config_paths = (_resolve_config_path(config.config),)
     else:
         config_paths = GLOBAL_CONFIG_PATHS
     for config_path in config_paths:
-        config_path = os.path.expanduser(os.path.expandvars(config_path))
-        if os.path.exists(config_path):
-            with open(config_path, "rt") as tomlf:
-                return toml.load(tomlf)
-    logger.info("Could not find any of the global configuration files %s.", config_paths)
+        try:
+            return toml_parser.loads(config_path.read_text())
+        except FileNotFoundError:
+            continue
+    logger.info(
+        "Could not find any of the global configuration files %s.",
+        ", ".join(map(str, config_paths)),
+    )
     return None
@@ -165,21 +165,29 @@ class IsaGraph:
                 logger.debug("starting from current node %s", s)
                 yield from self._dfs(s, seen, order, path)
 
-    def _dfs(self, curr, seen, order, path):
-        if self._node_types[curr] in (TYPE_MATERIAL, TYPE_PROCESS):
-            path.append(self._node_objs[curr])
-        if curr in seen:
-            return
-        else:
-            seen.add(curr)
-        if order == "pre":
-            yield curr, self._node_types[curr], self._node_objs[curr], tuple(path)
-        for other in self.forward[curr]:
-            yield from self._dfs(other, seen, order, path)
-        if order != "pre":
-            yield curr, self._node_types[curr], self._node_objs[curr], tuple(path)
-        if self._node_types[curr] in (TYPE_MATERIAL, TYPE_PROCESS):
-            path.pop()
+    def _dfs(self, start, seen, order, path):
+        # Iterative DFS with an explicit stack of ``(node, exiting)`` entries, the ``exiting``
+        # entry of a node is processed after all nodes reachable from it.
+        stack = [(start, False)]
+        while stack:
+            curr, exiting = stack.pop()
+            on_path = self._node_types[curr] in (TYPE_MATERIAL, TYPE_PROCESS)
+            if exiting:
+                if order != "pre":
+                    yield curr, self._node_types[curr], self._node_objs[curr], tuple(path)
+                if on_path:
+                    path.pop()
+                continue
+            if on_path:
+                path.append(self._node_objs[curr])
+            if curr in seen:
+                continue
+            else:
+                seen.add(curr)
+            if order == "pre":
+                yield curr, self._node_types[curr], self._node_objs[curr], tuple(path)
+            stack.append((curr, True))
+            stack.extend((other, False) for other in reversed(self.forward[curr]))
 
 
 class IsaNodeVisitor:
@@ -187,6 +195,10 @@ class IsaNodeVisitor:
     AssayTraversal classes.
     """
 
+    #: Material types that ``on_visit_material()`` is called for, ``None`` for all.  The traversal
+    #: classes skip the call for materials of other types.
+    interesting_types: typing.Optional[typing.FrozenSet[str]] = None
+
     def on_begin_investigation(self, investigation):
         logger.debug("begin investigation %s", investigation.info.path)
 
@@ -307,6 +319,7 @@ class StudyTraversal:
             TYPE_MATERIAL: (visitor.on_visit_node, visitor.on_visit_material),
             TYPE_PROCESS: (visitor.on_visit_node, visitor.on_visit_process),
         }
+        interesting_types = visitor.interesting_types
         if start_name:
             dfs_start = self.isa_graph.mat_node_by_name[start_name]
         else:
@@ -317,7 +330,14 @@ class StudyTraversal:
         # sample.
         for node_id, obj_type, obj, node_path in self.isa_graph.dfs(dfs_start):
             new_obj = obj
-            for func in func_mapping[obj_type]:
+            funcs = func_mapping[obj_type]
+            if (
+                obj_type == TYPE_MATERIAL
+                and interesting_types is not None
+                and obj.type not in interesting_types
+            ):
+                funcs = (visitor.on_visit_node,)
+            for func in funcs:
                 tmp_obj = func(obj, node_path=node_path, study=self.study)
                 new_obj = tmp_obj or new_obj
             if obj_type == TYPE_MATERIAL:
@@ -368,6 +388,7 @@ class AssayTraversal:
             TYPE_MATERIAL: (visitor.on_visit_node, visitor.on_visit_material),
             TYPE_PROCESS: (visitor.on_visit_node, visitor.on_visit_process),
         }
+        interesting_types = visitor.interesting_types
         if start_name:
             dfs_start = self.isa_graph.mat_node_by_name[start_name]
         else:
@@ -377,7 +398,14 @@ class AssayTraversal:
         # information to caller.
         for _node_id, obj_type, obj, node_path in self.isa_graph.dfs(dfs_start):
             new_obj = obj
-            for func in func_mapping[obj_type]:
+            funcs = func_mapping[obj_type]
+            if (
+                obj_type == TYPE_MATERIAL
+                and interesting_types is not None
+                and obj.type not in interesting_types
+            ):
+                funcs = (visitor.on_visit_node,)
+            for func in funcs:
                 tmp_obj = func(obj, node_path=node_path, study=self.study, assay=self.assay)
                 new_obj = tmp_obj or new_obj
             if obj_type == TYPE_MATERIAL:
@@ -396,7 +424,51 @@ class AssayTraversal:
         return attr.evolve(self.assay, materials=self._materials, processes=self._processes)
 
 
-def first_value(key, node_path, default=None, ignore_case=True):
+def _join_value(value):
+    """Join characteristic or parameter ``value`` list with ``";"``.
+
+    Single strings are returned as is.  Lists that cannot be joined (e.g., with ontology term
+    references) are returned unchanged and only joined when looked up by ``first_value()``.
+    """
+    if len(value) == 1 and isinstance(value[0], str):
+        return value[0]
+    try:
+        return ";".join(value)
+    except TypeError:
+        return value
+
+
+def _node_values(node, cache) -> typing.Dict[str, typing.Any]:
+    """Return the joined characteristics and parameter values of ``node`` by lower-case name.
+
+    The values are memoized in ``cache`` by node ID.  The node is stored alongside its values so
+    its ID cannot be reused while the entry exists.
+    """
+    entry = cache.get(id(node))
+    if entry is None or entry[0] is not node:
+        values: typing.Dict[str, typing.Any] = {}
+        for attr_type in ("characteristics", "parameter_values"):
+            for x in getattr(node, attr_type, ()):
+                name = x.name.lower()
+                if name not in values:
+                    values[name] = _join_value(x.value)
+        entry = cache[id(node)] = (node, values)
+    return entry[1]
+
+
+def first_value(key, node_path, default=None, ignore_case=True, cache=None):
+    """Return the first characteristic or parameter value named ``key`` along ``node_path``.
+
+    Pass a ``dict`` as ``cache`` to memoize the values of each node for case-insensitive lookups,
+    e.g., one per traversal.
+    """
+    if ignore_case and cache is not None:
+        key = key.lower()
+        for node in node_path:
+            value = _node_values(node, cache).get(key)
+            if value is not None:
+                return value if isinstance(value, str) else ";".join(value)
+        return default
     for node in node_path:
         for attr_type in ("characteristics", "parameter_values"):
             for x in getattr(node, attr_type, ()):
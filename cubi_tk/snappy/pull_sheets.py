@@ -9,8 +9,15 @@ More Information
 """
 
 import argparse
+import hashlib
+import io
+from itertools import chain
+import json
+from multiprocessing.pool import ThreadPool
 import os
 import pathlib
+import tempfile
+import threading
 import typing
 from uuid import UUID
 
@@ -20,6 +27,7 @@ from biomedsheets.naming import NAMING_ONLY_SECONDARY_ID
 from logzero import logger
 from sodar_cli import api
 
+from .. import __version__
 from ..common import CommonConfig, load_toml_config, overwrite_helper
 from ..isa_support import (
     InvestigationTraversal,
@@ -51,6 +59,12 @@ HEADER_TPL = (
     ),
 )
 
+#: The header lines joined into one string, including the final line break.
+HEADER_STR = "\n".join(HEADER_TPL) + "\n"
+
+#: Template for one row of the ``[Data]`` section, ``hpoTerms`` are not exported.
+ROW_TPL = "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t.\t{}\t{}\t{}"
+
 #: Mapping from ISA-tab sex to sample sheet sex.
 MAPPING_SEX = {"female": "F", "male": "M", "unknown": "U", None: "."}
 
@@ -58,6 +72,47 @@ MAPPING_SEX = {"female": "F", "male": "M", "unknown": "U", None: "."}
 MAPPING_STATUS = {"affected": "Y", "carrier": "Y", "unaffected": "N", "unknown": ".", None: "."}
 
 
+def _with_case_variants(mapping):
+    """Extend ``mapping`` by the upper-case and capitalized variants of its keys."""
+    result = dict(mapping)
+    for key, value in mapping.items():
+        if key:
+            result.setdefault(key.upper(), value)
+            result.setdefault(key.capitalize(), value)
+    return result
+
+
+#: ``MAPPING_SEX`` extended by common capitalizations, see ``_map_value()``.
+MAPPING_SEX_CI = _with_case_variants(MAPPING_SEX)
+
+#: ``MAPPING_STATUS`` extended by common capitalizations, see ``_map_value()``.
+MAPPING_STATUS_CI = _with_case_variants(MAPPING_STATUS)
+
+
+def _map_value(mapping_ci, value):
+    """Map ISA-tab ``value`` with a ``*_CI`` mapping, ignoring case.
+
+    Only values in uncommon capitalization need to be lower-cased first.
+    """
+    try:
+        return mapping_ci[value]
+    except KeyError:
+        return mapping_ci[value.lower()]
+
+
+#: Library types inferred from the last dash-separated component of the library name, by the
+#: first three characters of the library type (these are unique).
+LIBRARY_TYPES_BY_PREFIX = {
+    library_type[:3]: library_type
+    for library_type in ("WGS", "WES", "Panel_seq", "mRNA_seq", "RNA_seq")
+}
+
+#: Default directory for caching generated sheets.
+DEFAULT_CACHE_DIR = (
+    pathlib.Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser() / "cubi-tk" / "sheets"
+)
+
+
 @attr.s(frozen=True, auto_attribs=True)
 class PullSheetsConfig:
     """Configuration for the ``cubi-tk snappy pull-sheets`` command."""
@@ -74,6 +129,8 @@ class PullSheetsConfig:
     first_batch: int
     last_batch: typing.Union[int, type(None)]
     tsv_shortcut: str
+    #: Directory to cache generated sheets in, ``None`` to disable caching.
+    cache_dir: typing.Optional[pathlib.Path] = None
 
     @staticmethod
     def create(args, global_config, toml_config=None):
@@ -85,28 +142,28 @@ class PullSheetsConfig:
             dry_run=args.dry_run,
             show_diff=args.show_diff,
             show_diff_side_by_side=args.show_diff_side_by_side,
-            library_types=tuple(args.library_types),
+            library_types=args.library_types,
             first_batch=args.first_batch,
             last_batch=args.last_batch,
             tsv_shortcut=args.tsv_shortcut,
+            cache_dir=None if args.no_cache else DEFAULT_CACHE_DIR,
         )
 
 
-@attr.s(frozen=True, auto_attribs=True)
-class Source:
+class Source(typing.NamedTuple):
     family: typing.Optional[str]
     source_name: str
     batch_no: int
     father: str
     mother: str
+    #: Sex, as ISA-tab value.
     sex: str
+    #: Disease status, as ISA-tab value.
     affected: str
     sample_name: str
 
 
-@attr.s(frozen=True, auto_attribs=True)
-class Sample:
-    source: Source
+class Sample(typing.NamedTuple):
     library_name: str
     library_type: str
     folder_name: str
@@ -114,6 +171,13 @@ class Sample:
     library_kit: str
 
 
+#: Columns of the source table in ``SampleSheetBuilder``.
+SOURCE_COLUMNS = Source._fields
+
+#: Columns of the sample table in ``SampleSheetBuilder``.
+SAMPLE_COLUMNS = Sample._fields
+
+
 def strip(x):
     if hasattr(x, "strip"):
         return x.strip()
@@ -127,7 +191,7 @@ def setup_argparse(parser: argparse.ArgumentParser) -> None:
 
     parser.add_argument(
         "--base-path",
-        default=os.getcwd(),
+        default=None,
         required=False,
         help=(
             "Base path of project (contains '.snappy_pipeline/' etc.), spiders up from current "
@@ -162,7 +226,10 @@ def setup_argparse(parser: argparse.ArgumentParser) -> None:
     )
 
     parser.add_argument(
-        "--library-types", help="Library type(s) to use, comma-separated, default is to use all."
+        "--library-types",
+        default=(),
+        type=lambda x: tuple(x.split(",")) if x else (),
+        help="Library type(s) to use, comma-separated, default is to use all.",
     )
 
     parser.add_argument(
@@ -185,83 +252,147 @@ def setup_argparse(parser: argparse.ArgumentParser) -> None:
         help="The shortcut TSV schema to use; default: 'germline'.",
     )
 
+    parser.add_argument(
+        "--no-cache",
+        default=False,
+        action="store_true",
+        help=(
+            "Always build the sheets from the ISA-tab instead of reusing the sheets cached in %s "
+            "for unchanged ISA-tab."
+        )
+        % DEFAULT_CACHE_DIR,
+    )
+
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=None,
+        help=(
+            "Number of datasets to pull in parallel, 0 to pull sequentially.  Defaults to the "
+            "smaller of the number of datasets and the number of CPUs.  All sheets are built "
+            "before the first one is written, so nothing is written if any dataset fails."
+        ),
+    )
+
 
 def check_args(args) -> int:
     """Argument checks that can be checked at program startup but that cannot be sensibly checked with ``argparse``."""
     any_error = False
 
-    # Postprocess arguments.
-    if args.library_types:
-        args.library_types = args.library_types.split(",")  # pragma: nocover
-    else:
-        args.library_types = []
+    if args.num_workers is not None and args.num_workers < 0:
+        logger.error("--num-workers must not be negative but is %d", args.num_workers)
+        any_error = True
 
     return int(any_error)
 
 
 class SampleSheetBuilder(IsaNodeVisitor):
+    """Collect sources and samples in column-wise tables, one list per ``Source`` and ``Sample``
+    field, to avoid creating one object per record.
+    """
+
+    interesting_types = frozenset({"Sample Name", "Extract Name", "Library Name"})
+
     def __init__(self):
-        #: Source by sample name.
-        self.sources = {}
-        #: Sample by sample name.
-        self.samples = {}
+        #: Source table, columns by field name.
+        self.source_cols = {name: [] for name in SOURCE_COLUMNS}
+        #: Row in source table by sample name.
+        self.source_idx = {}
+        #: Sample table, columns by field name.
+        self.sample_cols = {name: [] for name in SAMPLE_COLUMNS}
+        #: Row in sample table by sample name.
+        self.sample_idx = {}
         #: The previous process.
         self.prev_process = None
+        #: Memoized node values for ``first_value()``.
+        self._first_value_cache = {}
+        #: Handler by material type, see ``interesting_types``.
+        self._dispatch = {
+            "Sample Name": self._on_visit_sample,
+            "Extract Name": self._on_visit_extract,
+            "Library Name": self._on_visit_library,
+        }
+
+    def reset(self):
+        """Clear all collected data so the builder can be reused for another investigation."""
+        for col in chain(self.source_cols.values(), self.sample_cols.values()):
+            col.clear()
+        self.source_idx.clear()
+        self.sample_idx.clear()
+        self._first_value_cache.clear()
+        self.prev_process = None
+
+    @staticmethod
+    def _put_row(cols, idx, key, **values):
+        """Append row to table ``cols`` or overwrite the row already stored for ``key``."""
+        row = idx.get(key)
+        if row is None:
+            idx[key] = len(idx)
+            for name, col in cols.items():
+                col.append(values[name])
+        else:
+            for name, col in cols.items():
+                col[row] = values[name]
 
     def on_visit_material(self, material, node_path, study=None, assay=None):
-        super().on_visit_material(material, node_path, study, assay)
-        material_path = [x for x in node_path if hasattr(x, "type")]
-        source = material_path[0]
-        if material.type == "Sample Name" and assay is None:
-            sample = material
-            characteristics = {c.name: c for c in source.characteristics}
-            comments = {c.name: c for c in source.comments}
-            batch = characteristics.get("Batch", comments.get("Batch"))
-            family = characteristics.get("Family", comments.get("Family"))
-            father = characteristics.get("Father", comments.get("Father"))
-            mother = characteristics.get("Mother", comments.get("Mother"))
-            sex = characteristics.get("Sex", comments.get("Sex"))
-            affected = characteristics.get("Disease status", comments.get("Disease status"))
-            self.sources[material.name] = Source(
-                family=family.value[0] if family else None,
-                source_name=source.name,
-                batch_no=batch.value[0] if batch else None,
-                father=father.value[0] if father else None,
-                mother=mother.value[0] if mother else None,
-                sex=sex.value[0] if sex else None,
-                affected=affected.value[0] if affected else None,
-                sample_name=sample.name,
-            )
-        elif material.type == "Library Name" or (
-            material.type == "Extract Name"
-            and self.prev_process.protocol_ref.startswith("Library construction")
-        ):
-            library = material
-            sample = material_path[0]
-            if library.name.split("-")[-1].startswith("WGS"):
-                library_type = "WGS"
-            elif library.name.split("-")[-1].startswith("WES"):
-                library_type = "WES"
-            elif library.name.split("-")[-1].startswith("Panel_seq"):
-                library_type = "Panel_seq"
-            elif library.name.split("-")[-1].startswith("mRNA_seq"):
-                library_type = "mRNA_seq"
-            elif library.name.split("-")[-1].startswith("RNA_seq"):
-                library_type = "RNA_seq"
-            else:
-                raise Exception("Cannot infer library type from %s" % library.name)
-
-            folder_name = first_value("Folder name", node_path)
-            if not folder_name:
-                folder_name = library.name
-            self.samples[sample.name] = Sample(
-                source=self.sources[sample.name],
-                library_name=library.name,
-                library_type=library_type,
-                folder_name=folder_name,
-                seq_platform=first_value("Platform", node_path),
-                library_kit=first_value("Library Kit", node_path),
-            )
+        handler = self._dispatch.get(material.type)
+        if handler is not None:
+            handler(material, node_path, study, assay)
+
+    def _on_visit_sample(self, material, node_path, study=None, assay=None):
+        if assay is not None:
+            return
+        source = next(x for x in node_path if hasattr(x, "type"))
+        sample = material
+        characteristics = {c.name: c for c in source.characteristics}
+        comments = {c.name: c for c in source.comments}
+        batch = characteristics.get("Batch", comments.get("Batch"))
+        family = characteristics.get("Family", comments.get("Family"))
+        father = characteristics.get("Father", comments.get("Father"))
+        mother = characteristics.get("Mother", comments.get("Mother"))
+        sex = characteristics.get("Sex", comments.get("Sex"))
+        affected = characteristics.get("Disease status", comments.get("Disease status"))
+        self._put_row(
+            self.source_cols,
+            self.source_idx,
+            material.name,
+            family=family.value[0] if family else None,
+            source_name=source.name,
+            batch_no=batch.value[0] if batch else None,
+            father=father.value[0] if father else None,
+            mother=mother.value[0] if mother else None,
+            sex=sex.value[0] if sex else None,
+            affected=affected.value[0] if affected else None,
+            sample_name=sample.name,
+        )
+
+    def _on_visit_extract(self, material, node_path, study=None, assay=None):
+        if self.prev_process.protocol_ref.startswith("Library construction"):
+            self._on_visit_library(material, node_path, study, assay)
+
+    def _on_visit_library(self, material, node_path, study=None, assay=None):
+        library = material
+        sample = next(x for x in node_path if hasattr(x, "type"))
+        tail = library.name.rpartition("-")[2]
+        library_type = LIBRARY_TYPES_BY_PREFIX.get(tail[:3])
+        if library_type is None or not tail.startswith(library_type):
+            raise Exception("Cannot infer library type from %s" % library.name)
+
+        folder_name = first_value("Folder name", node_path, cache=self._first_value_cache)
+        if not folder_name:
+            folder_name = library.name
+        if sample.name not in self.source_idx:
+            raise KeyError(sample.name)
+        self._put_row(
+            self.sample_cols,
+            self.sample_idx,
+            sample.name,
+            library_name=library.name,
+            library_type=library_type,
+            folder_name=folder_name,
+            seq_platform=first_value("Platform", node_path, cache=self._first_value_cache),
+            library_kit=first_value("Library Kit", node_path, cache=self._first_value_cache),
+        )
 
     def on_visit_process(self, process, node_path, study=None, assay=None):
         super().on_visit_node(process, study, assay)
@@ -269,21 +400,70 @@ class SampleSheetBuilder(IsaNodeVisitor):
         material_path = [x for x in node_path if hasattr(x, "type")]
         sample = material_path[0]
         if process.protocol_ref.startswith("Nucleic acid sequencing"):
-            self.samples[sample.name] = attr.evolve(
-                self.samples[sample.name], seq_platform=first_value("Platform", node_path)
+            self.sample_cols["seq_platform"][self.sample_idx[sample.name]] = first_value(
+                "Platform", node_path, cache=self._first_value_cache
             )
 
 
+def _read_cached_sheet(cache_path: pathlib.Path) -> typing.Optional[str]:
+    """Return the cached sheet at ``cache_path`` or ``None`` if missing or unreadable."""
+    try:
+        result = cache_path.read_text()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning("Could not read cached sheet %s, ignoring cache: %s", cache_path, e)
+        return None
+    logger.info("Using cached sheet %s", cache_path)
+    return result
+
+
+def _write_cached_sheet(cache_path: pathlib.Path, project_uuid: str, result_str: str) -> None:
+    """Write ``result_str`` to ``cache_path`` and remove stale sheets of the same project.
+
+    Failing to write the cache is not fatal, a warning is logged instead.
+    """
+    tmp_name = None
+    try:
+        # Write to temporary file first so concurrent pulls never see partial files.
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "wt", dir=cache_path.parent, suffix=".tmp", delete=False
+        ) as tmp_f:
+            tmp_name = tmp_f.name
+            tmp_f.write(result_str)
+        os.replace(tmp_name, cache_path)
+    except OSError as e:
+        logger.warning("Could not write cached sheet %s: %s", cache_path, e)
+        if tmp_name:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+        return
+
+    # Only the sheet for the current ISA-tab of a project is ever used again.
+    for stale_path in cache_path.parent.glob("%s-*.tsv" % project_uuid):
+        if stale_path != cache_path:
+            try:
+                stale_path.unlink()
+            except OSError as e:
+                logger.warning("Could not remove stale cached sheet %s: %s", stale_path, e)
+
+
 def build_sheet(
     config: PullSheetsConfig,
     project_uuid: typing.Union[str, UUID],
     first_batch: typing.Optional[int] = None,
     last_batch: typing.Optional[int] = None,
     tsv_shortcut: str = "germline",
+    builder: typing.Optional[SampleSheetBuilder] = None,
 ) -> str:
-    """Build sheet TSV file."""
+    """Build sheet TSV file.
 
-    result = []
+    A ``builder`` can be passed in for reuse, it is reset before use.  Builders must not be
+    shared between threads.
+    """
 
     # Obtain ISA-tab from SODAR REST API.
     isa_dict = api.samplesheet.export(
@@ -291,44 +471,89 @@ def build_sheet(
         sodar_api_token=config.global_config.sodar_api_token,
         project_uuid=project_uuid,
     )
+
+    # Normalize once, the project UUID is both written to the sheet and part of the cache path.
+    project_uuid = str(project_uuid).strip()
+
+    # Reuse the previously generated sheet if neither the ISA-tab nor the parameters changed.
+    cache_path = None
+    if config.cache_dir:
+        cache_key = json.dumps(
+            [__version__, isa_dict, config.library_types, first_batch, last_batch, tsv_shortcut],
+            sort_keys=True,
+        )
+        cache_path = config.cache_dir / (
+            "%s-%s.tsv" % (project_uuid, hashlib.sha256(cache_key.encode("utf-8")).hexdigest())
+        )
+        cached = _read_cached_sheet(cache_path)
+        if cached is not None:
+            return cached
+
     isa = isa_dict_to_isa_data(isa_dict)
 
-    builder = SampleSheetBuilder()
+    if builder is None:
+        builder = SampleSheetBuilder()
+    else:
+        builder.reset()
     iwalker = InvestigationTraversal(isa.investigation, isa.studies, isa.assays)
     iwalker.run(builder)
 
-    # Generate the resulting sample sheet.
-    for sample_name, source in builder.sources.items():
-        sample = builder.samples.get(sample_name, None)
-        if not config.library_types or not sample or sample.library_type in config.library_types:
-            row = [
-                source.family or "FAM",
-                source.source_name or ".",
-                source.father or "0",
-                source.mother or "0",
-                MAPPING_SEX[source.sex.lower()],
-                MAPPING_STATUS[source.affected.lower()],
-                sample.library_type or "." if sample else ".",
-                sample.folder_name or "." if sample else ".",
-                "0" if source.batch_no is None else source.batch_no,
-                ".",
-                str(project_uuid),
-                sample.seq_platform or "." if sample else ".",
-                sample.library_kit or "." if sample else ".",
-            ]
-            result.append("\t".join([c.strip() for c in row]))
+    # Generate the rows of the resulting sample sheet from the builder's tables, only keeping the
+    # sources without sample or with a sample of the selected library types.
+    source_cols = builder.source_cols
+    sample_cols = builder.sample_cols
+    patient_names = []
+    result = []
+    for i, sample_name in enumerate(source_cols["sample_name"]):
+        j = builder.sample_idx.get(sample_name)
+        if j is None:
+            library_type = folder_name = seq_platform = library_kit = "."
+        elif config.library_types and sample_cols["library_type"][j] not in config.library_types:
+            continue
+        else:
+            library_type = (sample_cols["library_type"][j] or ".").strip()
+            folder_name = (sample_cols["folder_name"][j] or ".").strip()
+            seq_platform = (sample_cols["seq_platform"][j] or ".").strip()
+            library_kit = (sample_cols["library_kit"][j] or ".").strip()
+        batch_no = source_cols["batch_no"][i]
+        patient_name = (source_cols["source_name"][i] or ".").strip()
+        patient_names.append(patient_name)
+        result.append(
+            ROW_TPL.format(
+                (source_cols["family"][i] or "FAM").strip(),
+                patient_name,
+                (source_cols["father"][i] or "0").strip(),
+                (source_cols["mother"][i] or "0").strip(),
+                _map_value(MAPPING_SEX_CI, source_cols["sex"][i]),
+                _map_value(MAPPING_STATUS_CI, source_cols["affected"][i]),
+                library_type,
+                folder_name,
+                "0" if batch_no is None else batch_no.strip(),
+                project_uuid,
+                seq_platform,
+                library_kit,
+            )
+        )
 
     load_tsv = getattr(io_tsv, "read_%s_tsv_sheet" % tsv_shortcut)
     sheet = load_tsv(list(HEADER_TPL) + result, naming_scheme=NAMING_ONLY_SECONDARY_ID)
     parser = ParseSampleSheet()
-    samples_in_batch = list(parser.yield_sample_names(sheet, first_batch, last_batch))
-    result = (
-        list(HEADER_TPL)
-        + [line if line.split("\t")[1] in samples_in_batch else "#" + line for line in result]
-        + [""]
-    )
+    samples_in_batch = set(parser.yield_sample_names(sheet, first_batch, last_batch))
+
+    # Write out the sheet, commenting out the rows of samples outside the selected batches.
+    buf = io.StringIO()
+    buf.write(HEADER_STR)
+    for patient_name, line in zip(patient_names, result):
+        if patient_name not in samples_in_batch:
+            buf.write("#")
+        buf.write(line)
+        buf.write("\n")
+    result_str = buf.getvalue()
 
-    return "\n".join(result)
+    if cache_path and not config.dry_run:
+        _write_cached_sheet(cache_path, project_uuid, result_str)
+
+    return result_str
 
 
 def run(
@@ -345,23 +570,47 @@ def run(
     logger.debug("Load config...")
     toml_config = load_toml_config(args)
     global_config = CommonConfig.create(args, toml_config)
-    args.base_path = find_snappy_root_dir(args.base_path)
+    args.base_path = find_snappy_root_dir(args.base_path or os.getcwd())
     config = PullSheetsConfig.create(args, global_config, toml_config)
 
     config_path = config.base_path / ".snappy_pipeline"
     datasets = load_datasets(config_path / "config.yaml")
     logger.info("Pulling for %d datasets", len(datasets))
-    for dataset in datasets.values():
-        if dataset.sodar_uuid:
-            overwrite_helper(
-                config_path / dataset.sheet_file,
-                build_sheet(
-                    config, dataset.sodar_uuid, args.first_batch, args.last_batch, args.tsv_shortcut
-                ),
-                do_write=not args.dry_run,
-                show_diff=True,
-                show_diff_side_by_side=args.show_diff_side_by_side,
-                answer_yes=args.yes,
-            )
+    todo_datasets = [dataset for dataset in datasets.values() if dataset.sodar_uuid]
+    if args.num_workers is None:
+        num_workers = min(len(todo_datasets), os.cpu_count() or 1)
+    else:
+        num_workers = args.num_workers
+
+    # Reuse one builder per worker thread.
+    thread_local = threading.local()
+
+    def _build_sheet(dataset):
+        if not hasattr(thread_local, "builder"):
+            thread_local.builder = SampleSheetBuilder()
+        return build_sheet(
+            config,
+            dataset.sodar_uuid,
+            args.first_batch,
+            args.last_batch,
+            args.tsv_shortcut,
+            builder=thread_local.builder,
+        )
+
+    # Pull the sheets in parallel but write them sequentially so the diff prompts do not mix.
+    if num_workers <= 1:
+        sheets = list(map(_build_sheet, todo_datasets))
+    else:
+        with ThreadPool(processes=num_workers) as pool:
+            sheets = pool.map(_build_sheet, todo_datasets)
+    for dataset, sheet in zip(todo_datasets, sheets):
+        overwrite_helper(
+            config_path / dataset.sheet_file,
+            sheet,
+            do_write=not args.dry_run,
+            show_diff=True,
+            show_diff_side_by_side=args.show_diff_side_by_side,
+            answer_yes=args.yes,
+        )
 
     return None
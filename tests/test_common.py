@@ -1,5 +1,6 @@
 """Tests for common code."""
 
+import argparse
 import subprocess
 
 from pyfakefs import fake_filesystem
@@ -46,3 +47,16 @@ def test_execute_shell_commands():
     except subprocess.CalledProcessError:
         raise_error = True
     assert raise_error
+
+
+def test_load_toml_config(tmp_path):
+    config_path = tmp_path / "cubitkrc.toml"
+    config_path.write_text('[global]\nsodar_server_url = "https://sodar.example.com"\n')
+
+    args = argparse.Namespace(config=str(config_path))
+    assert common.load_toml_config(args) == {
+        "global": {"sodar_server_url": "https://sodar.example.com"}
+    }
+
+    args = argparse.Namespace(config=str(tmp_path / "missing.toml"))
+    assert common.load_toml_config(args) is None
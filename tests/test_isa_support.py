@@ -0,0 +1,34 @@
+"""Tests for ``cubi_tk.isa_support``."""
+
+import pathlib
+
+import pytest
+
+from cubi_tk.isa_support import first_value, load_investigation
+
+
+@pytest.fixture
+def source_material():
+    """Returns the first source of the ISA-tab test study, it has an ontology term characteristic"""
+    path = (
+        pathlib.Path(__file__).resolve().parent / "data" / "ISA_files_test" / "i_Investigation.txt"
+    )
+    isa = load_investigation(path)
+    study = next(iter(isa.studies.values()))
+    return next(m for m in study.materials.values() if m.type == "Source Name")
+
+
+@pytest.mark.parametrize("cache", [None, {}])
+def test_first_value(source_material, cache):
+    assert first_value("sex", [source_material], cache=cache) == "UNKNOWN"
+    assert first_value("Sex", [source_material], ignore_case=False, cache=cache) == "UNKNOWN"
+    assert first_value("sex", [source_material], ignore_case=False, cache=cache) is None
+    assert first_value("missing", [source_material], default=".", cache=cache) == "."
+    with pytest.raises(TypeError):
+        first_value("Organism", [source_material], cache=cache)
+
+
+def test_first_value_cache(source_material):
+    cache = {}
+    first_value("sex", [source_material], cache=cache)
+    assert cache[id(source_material)][0] is source_material
@@ -3,10 +3,12 @@
 import json
 import pathlib
 
+import attr
 import pytest
 
+from cubi_tk.__main__ import main
 from cubi_tk.common import CommonConfig
-from cubi_tk.snappy.pull_sheets import PullSheetsConfig, build_sheet
+from cubi_tk.snappy.pull_sheets import HEADER_STR, PullSheetsConfig, SampleSheetBuilder, build_sheet
 
 
 @pytest.fixture
@@ -47,3 +49,133 @@ def test_build_sheet_germline(mocker, pull_sheet_config):
     mocker.patch("sodar_cli.api.samplesheet.export", return_value=load_germline_isa_dict())
     actual = build_sheet(config=pull_sheet_config, project_uuid="")
     assert actual == expected
+
+
+def test_build_sheet_germline_unmapped_sex_filtered_out(mocker, pull_sheet_config):
+    """Tests ``build_sheet()`` - sex and status are only mapped for rows written to the sheet"""
+    isa_dict = load_germline_isa_dict()
+    study = next(iter(isa_dict["studies"].values()))
+    lines = study["tsv"].split("\n")
+    col = lines[0].split("\t").index("Characteristics[Sex]")
+    row = lines[1].split("\t")
+    row[col] = "not provided"
+    lines[1] = "\t".join(row)
+    study["tsv"] = "\n".join(lines)
+    mocker.patch("sodar_cli.api.samplesheet.export", return_value=isa_dict)
+
+    config = attr.evolve(pull_sheet_config, library_types=("WGS",))
+    assert build_sheet(config=config, project_uuid="") == HEADER_STR
+    with pytest.raises(KeyError):
+        build_sheet(config=pull_sheet_config, project_uuid="")
+
+
+def test_build_sheet_germline_cached(mocker, pull_sheet_config, tmp_path):
+    """Tests ``build_sheet()`` - sheet is written to and then read from the cache"""
+    config = attr.evolve(pull_sheet_config, cache_dir=tmp_path)
+    mocker.patch("sodar_cli.api.samplesheet.export", return_value=load_germline_isa_dict())
+    expected = build_sheet(config=config, project_uuid="")
+    cache_files = list(tmp_path.glob("*.tsv"))
+    assert len(cache_files) == 1
+    assert cache_files[0].read_text() == expected
+
+    mock_builder = mocker.patch("cubi_tk.snappy.pull_sheets.SampleSheetBuilder")
+    assert build_sheet(config=config, project_uuid="") == expected
+    mock_builder.assert_not_called()
+
+    # A changed sheet replaces the stale one of the same project.
+    build_sheet(config=config, project_uuid="", last_batch=0)
+    assert list(tmp_path.glob("*.tsv")) != cache_files
+    assert len(list(tmp_path.glob("*.tsv"))) == 1
+
+
+def test_build_sheet_germline_cached_project_uuid_normalized(mocker, pull_sheet_config, tmp_path):
+    """Tests ``build_sheet()`` - stale sheets are pruned regardless of project UUID spelling"""
+    config = attr.evolve(pull_sheet_config, cache_dir=tmp_path)
+    mocker.patch("sodar_cli.api.samplesheet.export", return_value=load_germline_isa_dict())
+    build_sheet(config=config, project_uuid="uuid")
+    build_sheet(config=config, project_uuid=" uuid\n", last_batch=0)
+    cache_files = list(tmp_path.glob("*.tsv"))
+    assert len(cache_files) == 1
+    assert cache_files[0].name.startswith("uuid-")
+
+
+def test_build_sheet_germline_cache_not_written(mocker, pull_sheet_config, tmp_path):
+    """Tests ``build_sheet()`` - cache is neither written on dry runs nor required to work"""
+    mocker.patch("sodar_cli.api.samplesheet.export", return_value=load_germline_isa_dict())
+    expected = build_sheet(config=pull_sheet_config, project_uuid="")
+
+    config = attr.evolve(pull_sheet_config, cache_dir=tmp_path, dry_run=True)
+    assert build_sheet(config=config, project_uuid="") == expected
+    assert not list(tmp_path.iterdir())
+
+    (tmp_path / "file").write_text("")
+    config = attr.evolve(pull_sheet_config, cache_dir=tmp_path / "file" / "sheets")
+    assert build_sheet(config=config, project_uuid="") == expected
+
+
+def test_build_sheet_germline_reuse_builder(mocker, pull_sheet_config):
+    """Tests ``build_sheet()`` - reusing a ``SampleSheetBuilder`` yields the same sheet"""
+    mocker.patch("sodar_cli.api.samplesheet.export", return_value=load_germline_isa_dict())
+    builder = SampleSheetBuilder()
+    first = build_sheet(config=pull_sheet_config, project_uuid="", builder=builder)
+    second = build_sheet(config=pull_sheet_config, project_uuid="", builder=builder)
+    assert first == second
+    assert len(builder.source_idx) == 3
+
+
+def _write_snappy_config(base_path, num_datasets):
+    """Write a minimal snappy configuration with ``num_datasets`` SODAR-backed data sets."""
+    (base_path / ".snappy_pipeline").mkdir()
+    lines = ["static_data_config: {}", "step_config: {}", "data_sets:"]
+    for i in range(num_datasets):
+        lines += [
+            "  batch%d:" % i,
+            "    file: sheet%d.tsv" % i,
+            "    search_patterns: []",
+            "    search_paths: ['/path']",
+            "    type: germline_variants",
+            "    naming_scheme: only_secondary_id",
+            "    sodar_uuid: 99999999-aaaa-bbbb-cccc-99999999999%d" % i,
+        ]
+    (base_path / ".snappy_pipeline" / "config.yaml").write_text("\n".join(lines) + "\n")
+
+
+def test_run_snappy_pull_sheets_smoke_test(mocker, tmp_path):
+    _write_snappy_config(tmp_path, 2)
+    mock_export = mocker.patch(
+        "sodar_cli.api.samplesheet.export", return_value=load_germline_isa_dict()
+    )
+    argv = [
+        "--sodar-server-url",
+        "https://sodar.example.com/",
+        "--sodar-api-token",
+        "XXXX",
+        "snappy",
+        "pull-sheets",
+        "--base-path",
+        str(tmp_path),
+        "--library-types",
+        "WES",
+        "--no-cache",
+        "--num-workers",
+        "2",
+        "--yes",
+    ]
+
+    res = main(argv)
+
+    assert not res
+    assert mock_export.call_count == 2
+    sheet_paths = sorted((tmp_path / ".snappy_pipeline").glob("sheet*.tsv"))
+    assert [p.name for p in sheet_paths] == ["sheet0.tsv", "sheet1.tsv"]
+    for i, sheet_path in enumerate(sheet_paths):
+        assert "99999999-aaaa-bbbb-cccc-99999999999%d" % i in sheet_path.read_text()
+
+
+def test_run_snappy_pull_sheets_negative_num_workers(mocker, tmp_path):
+    _write_snappy_config(tmp_path, 2)
+    mock_export = mocker.patch("sodar_cli.api.samplesheet.export")
+    argv = ["snappy", "pull-sheets", "--base-path", str(tmp_path), "--num-workers", "-1"]
+
+    assert main(argv) == 1
+    mock_export.assert_not_called()